@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 import argparse
+import filecmp
 import math
 import multiprocessing
 import os
@@ -8,18 +9,49 @@ import shutil
 import signal
 import subprocess
 import sys
-from functools import partial
-from multiprocessing.dummy import Pool as ThreadPool
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from python.lib.colors import red, green, yellow, blue
 from python.lib.kphp_builder import KphpBuilder
-from python.lib.file_utils import read_distcc_hosts, error_can_be_ignored
+from python.lib.file_utils import read_distcc_hosts, search_kphp2cpp, make_ignore_regex, error_can_be_ignored
+
+_TESTER_DIR = os.path.abspath(os.path.dirname(__file__))
+_VKEXT_DIR = os.path.join(os.path.dirname(_TESTER_DIR), "objs", "vkext")
+
+_PHP5_BIN = shutil.which("php5.6") or shutil.which("php5")
+_PHP7_4_BIN = shutil.which("php7.4")
+_PHP7_BIN = shutil.which("php7.2") or shutil.which("php7.3") or _PHP7_4_BIN
+
+_PHP_EXTENSION_ARGS = tuple("-d extension='{}'".format(extension) for extension in [
+    "json.so",
+    "bcmath.so",
+    "iconv.so",
+    "mbstring.so",
+    "curl.so",
+    "tokenizer.so",
+    "h3.so",
+])
+
+_PHP_SETTING_ARGS = tuple("-d {}='{}'".format(k, v) for k, v in [
+    ("display_errors", 0),
+    ("log_errors", 1),
+    ("memory_limit", "3072M"),
+    ("xdebug.var_display_max_depth", -1),
+    ("xdebug.var_display_max_children", -1),
+    ("xdebug.var_display_max_data", -1),
+])
+
+_KPHP_RUNTIME_STDERR_IGNORE_REGEX = make_ignore_regex(
+    rb"\[\d+\]\[\d{4}\-\d{2}\-\d{2} \d{2}:\d{2}:\d{2}\.\d+ php\-runner\.cpp[^\S\n]+\d+\].+"
+)
 
 
 class TestFile:
     def __init__(self, file_path, test_tmp_dir, tags, env_vars: dict, out_regexps=None):
         self.test_tmp_dir = test_tmp_dir
         self.file_path = file_path
+        self.display_path = file_path
         self.tags = tags
         self.env_vars = env_vars
         self.out_regexps = out_regexps
@@ -40,74 +72,72 @@ class TestFile:
         return "php7_4" in self.tags
 
 
+# these are set up in each test worker by _init_test_worker()
+_kphp_build_semaphore = None
+_kphp_build_jobs = None
+_test_run_semaphore = None
+_stop_event = None
+
+
 class KphpRunOnceRunner(KphpBuilder):
-    def __init__(self, test_file: TestFile, distcc_hosts):
+    def __init__(self, test_file: TestFile, kphp_path, distcc_hosts, timeouts):
         super(KphpRunOnceRunner, self).__init__(
             php_script_path=test_file.file_path,
             artifacts_dir=os.path.join(test_file.test_tmp_dir, "artifacts"),
-            working_dir=os.path.abspath(os.path.join(test_file.test_tmp_dir, "working_dir")),
-            distcc_hosts=distcc_hosts
+            working_dir=os.path.join(test_file.test_tmp_dir, "working_dir"),
+            distcc_hosts=distcc_hosts,
+            kphp_build_timeout=timeouts.kphp_build,
+            kphp_path=kphp_path,
+            stop_event=_stop_event
         )
 
         self._test_file = test_file
-        self._php_stdout = None
-        self._kphp_server_stdout = None
+        self._php_timeout = timeouts.php
+        self._kphp_run_timeout = timeouts.kphp_run
+        self._php_stdout_file = os.path.join(self._working_dir, "php_stdout")
+        self._kphp_server_stdout_file = os.path.join(self._working_dir, "kphp_server_stdout")
         self._php_tmp_dir = os.path.join(self._working_dir, "php")
         self._kphp_runtime_tmp_dir = os.path.join(self._working_dir, "kphp_runtime")
-        self._tester_dir = os.path.abspath(os.path.dirname(__file__))
-        self._include_dirs.append(os.path.join(self._tester_dir, "php_include"))
-        self._vkext_dir = os.path.abspath(os.path.join(self._tester_dir, os.path.pardir, "objs", "vkext"))
+        self._include_dirs.append(os.path.join(_TESTER_DIR, "php_include"))
 
     def run_with_php(self):
         self._clear_working_dir(self._php_tmp_dir)
 
-        options = [
-            ("extension", "json.so"),
-            ("extension", "bcmath.so"),
-            ("extension", "iconv.so"),
-            ("extension", "mbstring.so"),
-            ("extension", "curl.so"),
-            ("extension", "tokenizer.so"),
-            ("extension", "h3.so"),
-        ]
-
         if self._test_file.is_php5():
-            php_bin = shutil.which("php5.6") or shutil.which("php5")
+            php_bin = _PHP5_BIN
         elif self._test_file.is_php7_4():
-            php_bin = shutil.which("php7.4")
+            php_bin = _PHP7_4_BIN
         else:
-            php_bin = shutil.which("php7.2") or shutil.which("php7.3") or shutil.which("php7.4")
+            php_bin = _PHP7_BIN
 
         if php_bin is None:
             raise RuntimeError("Can't find php executable")
 
         vkext_so = None
         if php_bin.endswith("php7.2"):
-            vkext_so = os.path.join(self._vkext_dir, "modules7.2", "vkext.so")
+            vkext_so = os.path.join(_VKEXT_DIR, "modules7.2", "vkext.so")
         elif php_bin.endswith("php7.4"):
-            vkext_so = os.path.join(self._vkext_dir, "modules7.4", "vkext.so")
+            vkext_so = os.path.join(_VKEXT_DIR, "modules7.4", "vkext.so")
 
         if not vkext_so or not os.path.exists(vkext_so):
             vkext_so = "vkext.so"
 
-        options.append(("extension", vkext_so))
-
-        options.extend([
-            ("display_errors", 0),
-            ("log_errors", 1),
-            ("memory_limit", "3072M"),
-            ("xdebug.var_display_max_depth", -1),
-            ("xdebug.var_display_max_children", -1),
-            ("xdebug.var_display_max_data", -1),
-            ("include_path", "{}:{}".format(*self._include_dirs))
-        ])
-
-        cmd = [php_bin, "-n"]
-        for k, v in options:
-            cmd.append("-d {}='{}'".format(k, v))
-        cmd.append(self._test_file_path)
-        php_proc = subprocess.Popen(cmd, cwd=self._php_tmp_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        self._php_stdout, php_stderr = self._wait_proc(php_proc)
+        cmd = [
+            php_bin, "-n",
+            *_PHP_EXTENSION_ARGS,
+            "-d extension='{}'".format(vkext_so),
+            *_PHP_SETTING_ARGS,
+            "-d include_path='{}:{}'".format(*self._include_dirs),
+            self._test_file_path
+        ]
+        with _test_run_semaphore, \
+                open(self._php_stdout_file, 'wb') as php_stdout, \
+                tempfile.TemporaryFile(dir=self._working_dir) as php_stderr_file:
+            self._raise_if_stopped()
+            php_proc = subprocess.Popen(cmd, cwd=self._php_tmp_dir, stdout=php_stdout, stderr=php_stderr_file,
+                                        start_new_session=True)
+            _, fake_stderr = self._wait_proc(php_proc, timeout=self._php_timeout)
+            php_stderr = self._read_proc_output(php_stderr_file) + (fake_stderr or b"")
 
         if php_stderr:
             self._move_to_artifacts("php_stderr", php_proc.returncode, content=php_stderr)
@@ -117,27 +147,41 @@ class KphpRunOnceRunner(KphpBuilder):
 
         return php_proc.returncode == 0
 
+    def compile_with_kphp(self, kphp_env=None):
+        env = {}
+        if not self._distcc_hosts:
+            env["KPHP_JOBS_COUNT"] = str(_kphp_build_jobs)
+            env["KPHP_THREADS_COUNT"] = str(_kphp_build_jobs)
+        env.update(kphp_env or {})
+        # kphp uses several cpu cores itself, so the number of simultaneous compilations is limited
+        with _kphp_build_semaphore:
+            return super(KphpRunOnceRunner, self).compile_with_kphp(env)
+
     def run_with_kphp(self):
         self._clear_working_dir(self._kphp_runtime_tmp_dir)
 
         sanitizer_log_name = "kphp_runtime_sanitizer_log"
-        env, sanitizer_glob_mask = self._prepare_sanitizer_env(self._kphp_runtime_tmp_dir, sanitizer_log_name)
+        env, sanitizer_log_prefix = self._prepare_sanitizer_env(self._kphp_runtime_tmp_dir, sanitizer_log_name)
 
         cmd = [self._kphp_runtime_bin, "-o", "--disable-sql", "--profiler-log-prefix", "profiler.log"]
         if not os.getuid():
             cmd += ["-u", "root", "-g", "root"]
-        kphp_server_proc = subprocess.Popen(cmd,
-                                            cwd=self._kphp_runtime_tmp_dir,
-                                            env=env,
-                                            stdout=subprocess.PIPE,
-                                            stderr=subprocess.PIPE)
-        self._kphp_server_stdout, kphp_runtime_stderr = self._wait_proc(kphp_server_proc)
-
-        self._move_sanitizer_logs_to_artifacts(sanitizer_glob_mask, kphp_server_proc, sanitizer_log_name)
+        with _test_run_semaphore, \
+                open(self._kphp_server_stdout_file, 'wb') as kphp_server_stdout, \
+                tempfile.TemporaryFile(dir=self._working_dir) as kphp_runtime_stderr_file:
+            self._raise_if_stopped()
+            kphp_server_proc = subprocess.Popen(cmd,
+                                                cwd=self._kphp_runtime_tmp_dir,
+                                                env=env,
+                                                stdout=kphp_server_stdout,
+                                                stderr=kphp_runtime_stderr_file,
+                                                start_new_session=True)
+            _, fake_stderr = self._wait_proc(kphp_server_proc, timeout=self._kphp_run_timeout)
+            kphp_runtime_stderr = self._read_proc_output(kphp_runtime_stderr_file) + (fake_stderr or b"")
+
+        self._move_sanitizer_logs_to_artifacts(sanitizer_log_prefix, kphp_server_proc, sanitizer_log_name)
         ignore_stderr = error_can_be_ignored(
-            ignore_patterns=[
-                "^\\[\\d+\\]\\[\\d{4}\\-\\d{2}\\-\\d{2} \\d{2}:\\d{2}:\\d{2}\\.\\d+ php\\-runner\\.cpp\\s+\\d+\\].+$"
-            ],
+            ignore_regex=_KPHP_RUNTIME_STDERR_IGNORE_REGEX,
             binary_error_text=kphp_runtime_stderr)
 
         if not ignore_stderr:
@@ -145,17 +189,25 @@ class KphpRunOnceRunner(KphpBuilder):
 
         return kphp_server_proc.returncode == 0
 
+    def try_remove_stdout_files(self):
+        # they are left if the test failed before the stdout comparison
+        for stdout_file in (self._php_stdout_file, self._kphp_server_stdout_file):
+            try:
+                os.remove(stdout_file)
+            except FileNotFoundError:
+                pass
+
     def compare_php_and_kphp_stdout(self):
-        if self._kphp_server_stdout == self._php_stdout:
+        if filecmp.cmp(self._php_stdout_file, self._kphp_server_stdout_file, shallow=False):
+            os.remove(self._php_stdout_file)
+            os.remove(self._kphp_server_stdout_file)
             return True
 
         diff_artifact = self._move_to_artifacts("php_vs_kphp.diff", 1, b"TODO")
         php_stdout_file = os.path.join(self._artifacts_dir, "php_stdout")
-        with open(php_stdout_file, 'wb') as f:
-            f.write(self._php_stdout)
+        os.replace(self._php_stdout_file, php_stdout_file)
         kphp_server_stdout_file = os.path.join(self._artifacts_dir, "kphp_server_stdout")
-        with open(kphp_server_stdout_file, 'wb') as f:
-            f.write(self._kphp_server_stdout)
+        os.replace(self._kphp_server_stdout_file, kphp_server_stdout_file)
 
         with open(diff_artifact.file, 'wb') as f:
             subprocess.call(["diff", "--text", "-ud", php_stdout_file, kphp_server_stdout_file], stdout=f)
@@ -163,38 +215,43 @@ class KphpRunOnceRunner(KphpBuilder):
         return False
 
 
-def make_test_file(file_path, test_tmp_dir, test_tags):
+def read_file_lines(f, chunk_size=512):
+    # reads a file by small chunks, usually only the test header is needed and it fits into the first one
+    tail = b""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            if tail:
+                yield tail
+            return
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        yield from lines
+
+
+def make_test_file(file_path, test_tmp_dir, test_tags_regex):
     # if file doesn't exist it will fail late
     if file_path.endswith(".phpt") or not os.path.exists(file_path):
-        test_acceptable = True
-        for test_tag in test_tags:
-            test_acceptable = file_path.find(test_tag) != -1
-            if test_acceptable:
-                break
-        if not test_acceptable:
+        if test_tags_regex and not test_tags_regex.search(file_path):
             return None
 
         return TestFile(file_path, test_tmp_dir, ["ok"], {})
 
     with open(file_path, 'rb') as f:
-        first_line = f.readline().decode('utf-8')
-        if not first_line.startswith("@"):
+        lines = read_file_lines(f)
+        first_line = next(lines, b"")
+        if not first_line.startswith(b"@"):
             return None
 
-        tags = first_line[1:].split()
-        test_acceptable = True
-        for test_tag in test_tags:
-            test_acceptable = (test_tag in tags) or (file_path.find(test_tag) != -1)
-            if test_acceptable:
-                break
-
-        if not test_acceptable:
+        tags = first_line[1:].decode('utf-8').split()
+        if test_tags_regex and not test_tags_regex.search(file_path) and \
+                not any(test_tags_regex.fullmatch(tag) for tag in tags):
             return None
 
         out_regexps = []
         env_vars = {}  # string -> string, e.g. {"KPHP_REQUIRE_FUNCTIONS_TYPING" -> "1"}
         while True:
-            second_line = f.readline().decode('utf-8').strip()
+            second_line = next(lines, b"").decode('utf-8').strip()
             if len(second_line) > 1 and second_line.startswith("/") and second_line.endswith("/"):
                 out_regexps.append(re.compile(second_line[1:-1]))
             elif second_line.startswith("KPHP_") and "=" in second_line:
@@ -213,9 +270,12 @@ def parse_env_var_from_test_header(file_path, line):
 
 
 def test_files_from_dir(tests_dir):
-    for root, _, files in os.walk(tests_dir):
-        for file in files:
-            yield root, file
+    with os.scandir(tests_dir) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from test_files_from_dir(entry.path)
+            elif entry.name.endswith((".php", ".phpt")):
+                yield entry.path
 
 
 def test_files_from_list(tests_dir, test_list):
@@ -225,28 +285,44 @@ def test_files_from_list(tests_dir, test_list):
             if idx != -1:
                 line = line[:idx]
             line = line.strip()
-            if not line:
-                continue
-            yield tests_dir, line
+            if line.endswith((".php", ".phpt")):
+                yield os.path.join(tests_dir, line)
 
 
 def collect_tests(tests_dir, test_tags, test_list):
     tests = []
-    tmp_dir = "{}_tmp".format(__file__[:-3])
+    tmp_dir = os.path.join(_TESTER_DIR, "kphp_tester_tmp")
+    # tmp dirs of tests repeat their paths relative to the parent of tests_dir
+    tests_dir_parent_prefix = os.path.join(os.path.dirname(tests_dir), "")
+    # tests paths are absolute, the ones inside the current dir are shown relative to it
+    cwd_prefix = os.path.join(os.getcwd(), "")
     file_it = test_files_from_list(tests_dir, test_list) if test_list else test_files_from_dir(tests_dir)
-    for root, file in file_it:
-        if file.endswith(".php") or file.endswith(".phpt"):
-            test_file_path = os.path.join(root, file)
-            test_tmp_dir = os.path.join(tmp_dir, os.path.relpath(test_file_path, os.path.dirname(tests_dir)))
-            test_tmp_dir = test_tmp_dir[:-4] if test_tmp_dir.endswith(".php") else test_tmp_dir[:-5]
-            test_file = make_test_file(test_file_path, test_tmp_dir, test_tags)
-            if test_file:
-                tests.append(test_file)
+    # a test is taken if any of the tags is a substring of its path or one of its tags
+    test_tags_regex = re.compile("|".join(re.escape(test_tag) for test_tag in test_tags)) if test_tags else None
+    for test_file_path in file_it:
+        if test_file_path.startswith(tests_dir_parent_prefix):
+            test_rel_path = test_file_path[len(tests_dir_parent_prefix):]
+        else:
+            test_rel_path = os.path.relpath(test_file_path, tests_dir_parent_prefix)
+        test_tmp_dir = os.path.join(tmp_dir, test_rel_path)
+        test_tmp_dir = test_tmp_dir[:-4] if test_tmp_dir.endswith(".php") else test_tmp_dir[:-5]
+        test_file = make_test_file(test_file_path, test_tmp_dir, test_tags_regex)
+        if test_file:
+            if test_file_path.startswith(cwd_prefix):
+                test_file.display_path = test_file_path[len(cwd_prefix):]
+            tests.append(test_file)
 
     tests.sort(reverse=True, key=lambda f: os.path.getsize(f.file_path))
     return tests
 
 
+class TestTimeouts:
+    def __init__(self, php, kphp_build, kphp_run):
+        self.php = php
+        self.kphp_build = kphp_build
+        self.kphp_run = kphp_run
+
+
 class TestResult:
     @staticmethod
     def failed(test_file, artifacts, failed_stage):
@@ -263,6 +339,7 @@ class TestResult:
     def __init__(self, status, test_file, artifacts, failed_stage):
         self.status = status
         self.test_file_path = test_file.file_path
+        self.test_display_path = test_file.display_path
         self.artifacts = None
         if artifacts is not None:
             self.artifacts = [(name, a) for name, a in artifacts.items() if a.error_priority >= 0]
@@ -272,11 +349,15 @@ class TestResult:
         if failed_stage:
             self.failed_stage_msg = red("({})".format(failed_stage))
 
-    def _print_artifacts(self):
+    def _print_with_artifacts(self, header_line):
+        # the report of a test is written at once, so it can't be split by other output
+        lines = [header_line]
         if self.artifacts:
             for file_type, artifact in self.artifacts:
                 file_type_colored = red(file_type) if artifact.error_priority else yellow(file_type)
-                print("  {} - {}".format(blue(artifact.file), file_type_colored), flush=True)
+                lines.append("  {} - {}".format(blue(artifact.file), file_type_colored))
+        sys.stdout.write("".join(line + "\n" for line in lines))
+        sys.stdout.flush()
 
     def print_short_report(self, total_tests, test_number):
         width = 1 + int(math.log10(total_tests))
@@ -289,19 +370,16 @@ class TestResult:
             if stderr_names:
                 additional_info = yellow("(got {})".format(stderr_names))
 
-        print("[{test_number}/{total_tests}] {status} {test_file} {additional_info}".format(
+        self._print_with_artifacts("[{test_number}/{total_tests}] {status} {test_file} {additional_info}".format(
             test_number=completed_str,
             total_tests=total_tests,
             status=self.status,
-            test_file=self.test_file_path,
-            additional_info=additional_info), flush=True)
-
-        self._print_artifacts()
+            test_file=self.test_display_path,
+            additional_info=additional_info))
 
     def print_fail_report(self):
         if self.failed_stage_msg:
-            print("{} {}".format(self.test_file_path, self.failed_stage_msg), flush=True)
-            self._print_artifacts()
+            self._print_with_artifacts("{} {}".format(self.test_display_path, self.failed_stage_msg))
 
     def is_skipped(self):
         return self.artifacts is None
@@ -365,31 +443,50 @@ def run_ok_test(test: TestFile, runner):
     return TestResult.passed(test, runner.artifacts)
 
 
-def run_test(distcc_hosts, test):
-    if not os.path.exists(test.file_path):
-        return TestResult.failed(test, None, "can't find test file")
+# keeps the settings that are the same for all tests, only the test specific parts are made per test
+class KphpRunnerFactory:
+    def __init__(self, kphp_path, distcc_hosts, timeouts):
+        self._kphp_path = kphp_path
+        self._distcc_hosts = distcc_hosts
+        self._timeouts = timeouts
 
-    runner = KphpRunOnceRunner(test, distcc_hosts)
-    runner.remove_artifacts_dir()
+    def make_runner(self, test):
+        return KphpRunOnceRunner(test, self._kphp_path, self._distcc_hosts, self._timeouts)
 
-    if test.is_kphp_should_fail():
-        test_result = run_fail_test(test, runner)
-    elif test.is_kphp_should_warn():
-        test_result = run_warn_test(test, runner)
-    elif test.is_ok():
-        test_result = run_ok_test(test, runner)
-    else:
-        test_result = TestResult.skipped(test)
+    def run_test(self, test):
+        if not os.path.exists(test.file_path):
+            return TestResult.failed(test, None, "can't find test file")
 
-    runner.try_remove_kphp_build_trash()
+        runner = self.make_runner(test)
+        runner.remove_artifacts_dir()
 
-    return test_result
+        try:
+            if test.is_kphp_should_fail():
+                test_result = run_fail_test(test, runner)
+            elif test.is_kphp_should_warn():
+                test_result = run_warn_test(test, runner)
+            elif test.is_ok():
+                test_result = run_ok_test(test, runner)
+            else:
+                test_result = TestResult.skipped(test)
+        finally:
+            runner.try_remove_stdout_files()
+            runner.try_remove_kphp_build_trash()
 
+        return test_result
 
-def run_all_tests(tests_dir, jobs, test_tags, no_report, passed_list, test_list, distcc_hosts):
-    hack_reference_exit = []
-    signal.signal(signal.SIGINT, lambda sig, frame: hack_reference_exit.append(1))
 
+def _init_test_worker(kphp_build_semaphore, kphp_build_jobs, test_run_semaphore, stop_event):
+    global _kphp_build_semaphore, _kphp_build_jobs, _test_run_semaphore, _stop_event
+    _kphp_build_semaphore = kphp_build_semaphore
+    _kphp_build_jobs = kphp_build_jobs
+    _test_run_semaphore = test_run_semaphore
+    _stop_event = stop_event
+    # SIGINT is handled by the parent process, it stops the workers via stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_all_tests(tests_dir, kphp_path, jobs, test_tags, no_report, passed_list, test_list, distcc_hosts, timeouts):
     tests = collect_tests(tests_dir, test_tags, test_list)
     if not tests:
         print("Can't find any tests with [{}] {}".format(
@@ -397,16 +494,46 @@ def run_all_tests(tests_dir, jobs, test_tags, no_report, passed_list, test_list,
             "tag" if len(test_tags) == 1 else "tags"))
         sys.exit(1)
 
+    cpu_count = multiprocessing.cpu_count()
+    if distcc_hosts:
+        # C++ code is compiled remotely, so the local cpu doesn't limit the number of compilations
+        kphp_build_slots = jobs
+    else:
+        kphp_build_slots = max(1, min(jobs, cpu_count // 5))
+    kphp_build_semaphore = multiprocessing.BoundedSemaphore(kphp_build_slots)
+    kphp_build_jobs = max(1, cpu_count // kphp_build_slots)
+    # php and kphp server runs are limited separately, so that compiling tests don't occupy their slots
+    test_run_semaphore = multiprocessing.BoundedSemaphore(jobs)
+
+    stop_event = multiprocessing.Event()
+    interrupted = False
     results = []
-    with ThreadPool(jobs) as pool:
-        tests_completed = 0
-        for test_result in pool.imap_unordered(partial(run_test, distcc_hosts), tests):
-            if hack_reference_exit:
-                print(yellow("Testing process was interrupted"), flush=True)
-                break
-            tests_completed = tests_completed + 1
-            test_result.print_short_report(len(tests), tests_completed)
-            results.append(test_result)
+    with ProcessPoolExecutor(max_workers=jobs + kphp_build_slots,
+                             initializer=_init_test_worker,
+                             initargs=(kphp_build_semaphore, kphp_build_jobs, test_run_semaphore,
+                                       stop_event)) as executor:
+        runner_factory = KphpRunnerFactory(kphp_path, distcc_hosts, timeouts)
+        futures = [executor.submit(runner_factory.run_test, test) for test in tests]
+        try:
+            tests_completed = 0
+            for future in as_completed(futures):
+                test_result = future.result()
+                tests_completed = tests_completed + 1
+                test_result.print_short_report(len(tests), tests_completed)
+                results.append(test_result)
+        except KeyboardInterrupt:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            interrupted = True
+            stop_event.set()
+            for pending_future in futures:
+                pending_future.cancel()
+            print(yellow("Testing process was interrupted"), flush=True)
+        except BaseException:
+            # don't let the executor shutdown run the queued tests before the error is shown
+            stop_event.set()
+            for pending_future in futures:
+                pending_future.cancel()
+            raise
 
     print("\nTesting results:", flush=True)
 
@@ -435,7 +562,7 @@ def run_all_tests(tests_dir, jobs, test_tags, no_report, passed_list, test_list,
             for test_result in results:
                 test_result.print_fail_report()
 
-    sys.exit(1 if failed else len(hack_reference_exit))
+    sys.exit(1 if failed or interrupted else 0)
 
 
 def parse_args():
@@ -493,11 +620,39 @@ def parse_args():
         default=None,
         help='list of available distcc hosts')
 
+    parser.add_argument(
+        '--php-timeout',
+        metavar='SECONDS',
+        type=int,
+        dest='php_timeout',
+        default=300,
+        help='timeout for running a test with php')
+
+    parser.add_argument(
+        '--kphp-build-timeout',
+        metavar='SECONDS',
+        type=int,
+        dest='kphp_build_timeout',
+        default=1200,
+        help='timeout for compiling a test with kphp')
+
+    parser.add_argument(
+        '--kphp-run-timeout',
+        metavar='SECONDS',
+        type=int,
+        dest='kphp_run_timeout',
+        default=300,
+        help='timeout for running a compiled kphp test')
+
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
+    if args.jobs < 1:
+        print("Number of parallel jobs must be positive")
+        sys.exit(1)
+
     if not os.path.exists(args.tests_dir):
         print("Can't find tests dir '{}'".format(args.test_list))
         sys.exit(1)
@@ -506,19 +661,28 @@ def main():
         print("Can't find test list file '{}'".format(args.test_list))
         sys.exit(1)
 
+    if _PHP7_BIN is None:
+        print("Can't find php executable")
+        sys.exit(1)
+
     try:
         distcc_hosts = read_distcc_hosts(args.distcc_host_list)
+        kphp_path = os.path.abspath(search_kphp2cpp())
     except Exception as ex:
         print(str(ex))
         sys.exit(1)
 
-    run_all_tests(tests_dir=os.path.normpath(args.tests_dir),
+    run_all_tests(tests_dir=os.path.abspath(args.tests_dir),
+                  kphp_path=kphp_path,
                   jobs=args.jobs,
                   test_tags=args.test_tags,
                   no_report=args.no_report,
                   passed_list=args.passed_list,
                   test_list=args.test_list,
-                  distcc_hosts=distcc_hosts)
+                  distcc_hosts=distcc_hosts,
+                  timeouts=TestTimeouts(php=args.php_timeout,
+                                        kphp_build=args.kphp_build_timeout,
+                                        kphp_run=args.kphp_run_timeout))
 
 
 if __name__ == "__main__":
@@ -69,33 +69,28 @@ def read_distcc_hosts(distcc_hosts_file):
     return distcc_hosts
 
 
-def error_can_be_ignored(ignore_patterns, binary_error_text):
-    if not binary_error_text:
-        return True
+def make_ignore_regex(*ignore_patterns):
+    # matches whole lines, so the patterns must not match '\n'
+    return re.compile(b"(?m)^(?:" + b"|".join(b"(?:" + pattern + b")" for pattern in ignore_patterns) + b")$\n?")
 
-    for line in binary_error_text.split(b'\n'):
-        if not line:
-            continue
-        is_line_ok = False
-        for pattern in ignore_patterns:
-            if re.fullmatch(pattern, line.decode()):
-                is_line_ok = True
-                break
 
-        if not is_line_ok:
-            return False
-    return True
+def error_can_be_ignored(ignore_regex, binary_error_text):
+    # all the ignored lines are removed in one pass, only the empty lines are allowed to remain
+    return not ignore_regex.sub(b"", binary_error_text or b"").strip(b"\n")
+
+
+_SANITIZER_LOG_IGNORE_REGEX = make_ignore_regex(
+    rb"==\d+==WARNING: ASan doesn't fully support makecontext/swapcontext functions and may produce false positives in some cases\!",
+    rb"==\d+==WARNING: ASan is ignoring requested __asan_handle_no_return: stack top.+",
+    rb"False positive error reports may follow",
+    rb"For details see .+"
+)
 
 
 def can_ignore_sanitizer_log(sanitizer_log_file):
     with open(sanitizer_log_file, 'rb') as f:
         ignore_sanitizer = error_can_be_ignored(
-            ignore_patterns=[
-                "^==\\d+==WARNING: ASan doesn't fully support makecontext/swapcontext functions and may produce false positives in some cases\\!$",
-                "^==\\d+==WARNING: ASan is ignoring requested __asan_handle_no_return: stack top.+$",
-                "^False positive error reports may follow$",
-                "^For details see .+$"
-            ],
+            ignore_regex=_SANITIZER_LOG_IGNORE_REGEX,
             binary_error_text=f.read())
 
     if ignore_sanitizer:
@@ -1,11 +1,24 @@
 import copy
-import glob
 import os
 import subprocess
 import shutil
+import signal
+import tempfile
+import time
 import multiprocessing
 
-from .file_utils import search_kphp2cpp, error_can_be_ignored, can_ignore_sanitizer_log, make_distcc_env
+from .file_utils import search_kphp2cpp, make_ignore_regex, error_can_be_ignored, can_ignore_sanitizer_log, \
+    make_distcc_env
+
+_KPHP_BUILD_STDERR_IGNORE_REGEX = make_ignore_regex(
+    rb"Starting php to cpp transpiling\.\.\.",
+    rb"Starting make\.\.\.",
+    rb"objs cnt = \d+",
+    rb"[^\S\n]*\d+\% \[total jobs \d+\] \[left jobs \d+\] \[running jobs \d+\] \[waiting jobs \d+\]"
+)
+
+# the output of a misbehaving process is truncated, so that it can't exhaust the memory
+_MAX_PROC_OUTPUT_SIZE = 4 * 1024 * 1024
 
 
 class Artifact:
@@ -15,19 +28,23 @@ class Artifact:
 
 
 class KphpBuilder:
-    def __init__(self, php_script_path, artifacts_dir, working_dir, distcc_hosts=None):
+    def __init__(self, php_script_path, artifacts_dir, working_dir, distcc_hosts=None, kphp_build_timeout=1200,
+                 kphp_path=None, stop_event=None):
         self.artifacts = {}
         self._kphp_build_stderr_artifact = None
         self._kphp_build_sanitizer_log_artifact = None
         self._artifacts_dir = artifacts_dir
 
-        self._kphp_path = os.path.abspath(search_kphp2cpp())
+        self._kphp_path = kphp_path or os.path.abspath(search_kphp2cpp())
         self._test_file_path = os.path.abspath(php_script_path)
         self._working_dir = working_dir
         self._include_dirs = [os.path.dirname(self._test_file_path)]
         self._kphp_build_tmp_dir = os.path.join(self._working_dir, "kphp_build")
         self._kphp_runtime_bin = os.path.join(self._kphp_build_tmp_dir, "server")
         self._distcc_hosts = distcc_hosts or []
+        self._kphp_build_timeout = kphp_build_timeout
+        # multiprocessing.Event, if it is set, running processes are killed and KeyboardInterrupt is raised
+        self._stop_event = stop_event
 
     @property
     def kphp_build_stderr_artifact(self):
@@ -52,36 +69,88 @@ class KphpBuilder:
             with open(artifact.file, 'wb') as f:
                 f.write(content)
         if file:
-            shutil.move(file, artifact.file)
+            os.replace(file, artifact.file)
         return artifact
 
+    def _raise_if_stopped(self):
+        if self._stop_event is not None and self._stop_event.is_set():
+            raise KeyboardInterrupt()
+
+    def _communicate(self, proc, timeout):
+        if self._stop_event is None:
+            return proc.communicate(timeout=timeout)
+
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return proc.communicate(timeout=max(0, min(1, deadline - time.monotonic())))
+            except subprocess.TimeoutExpired:
+                self._raise_if_stopped()
+                if time.monotonic() >= deadline:
+                    raise
+
     @staticmethod
-    def _wait_proc(proc, timeout=300):
+    def _kill_proc(proc):
+        # the process is expected to be started with start_new_session=True, kill its children too
         try:
-            stdout, stderr = proc.communicate(timeout=timeout)
-        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
             proc.kill()
+
+    def _wait_proc(self, proc, timeout=300):
+        try:
+            stdout, stderr = self._communicate(proc, timeout)
+        except KeyboardInterrupt:
+            self._kill_proc(proc)
             try:
-                stdout, stderr = proc.communicate(timeout=timeout)
+                proc.wait(timeout=5)
             except subprocess.TimeoutExpired:
-                os.system("kill -9 {}".format(proc.pid))
+                pass
+            raise
+        except subprocess.TimeoutExpired:
+            self._kill_proc(proc)
+            try:
+                stdout, stderr = proc.communicate(timeout=5)
+            except subprocess.TimeoutExpired:
+                try:
+                    os.kill(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
                 return None, b"Zombie detected?! Proc can't be killed due timeout!"
 
             stderr = (stderr or b"") + b"\n\nKilled due timeout\n"
         return stdout, stderr
 
+    @staticmethod
+    def _read_proc_output(output_file):
+        output_file.seek(0)
+        output = output_file.read(_MAX_PROC_OUTPUT_SIZE)
+        if output_file.read(1):
+            output += b"\n...TRUNCATED...\n"
+        return output
+
     @staticmethod
     def _clear_working_dir(dir_path):
-        if os.path.exists(dir_path):
-            bad_paths = []
-            shutil.rmtree(dir_path, onerror=lambda f, path, e: bad_paths.append(path))
+        # some php tests changes permissions, they are restored and the failed removal is retried once in place
+        retried_paths = set()
+
+        def on_rmtree_error(func, path, exc_info):
+            if not os.path.lexists(path):
+                return
+            if path in retried_paths:
+                raise exc_info[1]
+            retried_paths.add(path)
+            os.chmod(os.path.dirname(path), 0o777)
+            if func in (os.open, os.scandir, os.listdir):
+                # the directory can't be listed, remove it on its own after restoring the permissions
+                os.chmod(path, 0o777)
+                shutil.rmtree(path, onerror=on_rmtree_error)
+            else:
+                func(path)
 
-            # some php tests changes permissions
-            for bad_path in reversed(bad_paths):
-                os.chmod(bad_path, 0o777)
-            if bad_paths:
-                shutil.rmtree(dir_path)
-        os.makedirs(dir_path)
+        if os.path.exists(dir_path):
+            shutil.rmtree(dir_path, onerror=on_rmtree_error)
+        os.makedirs(dir_path, exist_ok=True)
 
     def remove_artifacts_dir(self):
         shutil.rmtree(self._artifacts_dir, ignore_errors=True)
@@ -89,20 +158,26 @@ class KphpBuilder:
     def try_remove_kphp_build_trash(self):
         shutil.rmtree(self._kphp_build_tmp_dir, ignore_errors=True)
 
+    @staticmethod
+    def _find_sanitizer_logs(sanitizer_log_prefix):
+        working_directory, log_name_prefix = os.path.split(sanitizer_log_prefix)
+        with os.scandir(working_directory) as it:
+            return [entry.path for entry in it if entry.name.startswith(log_name_prefix)]
+
     @staticmethod
     def _prepare_sanitizer_env(working_directory, sanitizer_log_name):
         tmp_sanitizer_file = os.path.join(working_directory, sanitizer_log_name)
-        sanitizer_glob_mask = "{}.*".format(tmp_sanitizer_file)
-        for old_sanitizer_file in glob.glob(sanitizer_glob_mask):
+        sanitizer_log_prefix = tmp_sanitizer_file + "."
+        for old_sanitizer_file in KphpBuilder._find_sanitizer_logs(sanitizer_log_prefix):
             os.remove(old_sanitizer_file)
 
         env = os.environ.copy()
         env["ASAN_OPTIONS"] = "detect_leaks=0:allocator_may_return_null=1:log_path={}".format(tmp_sanitizer_file)
         env["UBSAN_OPTIONS"] = "print_stacktrace=1:allow_addr2line=1:log_path={}".format(tmp_sanitizer_file)
-        return env, sanitizer_glob_mask
+        return env, sanitizer_log_prefix
 
-    def _move_sanitizer_logs_to_artifacts(self, sanitizer_glob_mask, proc, sanitizer_log_name):
-        for sanitizer_log in glob.glob(sanitizer_glob_mask):
+    def _move_sanitizer_logs_to_artifacts(self, sanitizer_log_prefix, proc, sanitizer_log_name):
+        for sanitizer_log in self._find_sanitizer_logs(sanitizer_log_prefix):
             if not can_ignore_sanitizer_log(sanitizer_log):
                 return self._move_to_artifacts(sanitizer_log_name, proc.returncode, file=sanitizer_log)
         return None
@@ -111,7 +186,7 @@ class KphpBuilder:
         os.makedirs(self._kphp_build_tmp_dir, exist_ok=True)
 
         sanitizer_log_name = "kphp_build_sanitizer_log"
-        env, sanitizer_glob_mask = self._prepare_sanitizer_env(self._kphp_build_tmp_dir, sanitizer_log_name)
+        env, sanitizer_log_prefix = self._prepare_sanitizer_env(self._kphp_build_tmp_dir, sanitizer_log_name)
         if kphp_env:
             env.update(kphp_env)
         env.setdefault("KPHP_THREADS_COUNT", "3")
@@ -130,26 +205,25 @@ class KphpBuilder:
             env.setdefault("KPHP_JOBS_COUNT", "2")
 
         # TODO kphp writes error into stdout and info into stderr
-        kphp_compilation_proc = subprocess.Popen(
-            [self._kphp_path, self._test_file_path],
-            cwd=self._kphp_build_tmp_dir,
-            env=env,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
-        )
-        kphp_build_stderr, fake_stderr = self._wait_proc(kphp_compilation_proc, timeout=1200)
+        self._raise_if_stopped()
+        with tempfile.TemporaryFile(dir=self._kphp_build_tmp_dir) as kphp_build_output:
+            kphp_compilation_proc = subprocess.Popen(
+                [self._kphp_path, self._test_file_path],
+                cwd=self._kphp_build_tmp_dir,
+                env=env,
+                stdout=kphp_build_output,
+                stderr=subprocess.STDOUT,
+                start_new_session=True
+            )
+            _, fake_stderr = self._wait_proc(kphp_compilation_proc, timeout=self._kphp_build_timeout)
+            kphp_build_stderr = self._read_proc_output(kphp_build_output)
         if fake_stderr:
-            kphp_build_stderr = (kphp_build_stderr or b'') + fake_stderr
+            kphp_build_stderr += fake_stderr
 
         self._kphp_build_sanitizer_log_artifact = self._move_sanitizer_logs_to_artifacts(
-            sanitizer_glob_mask, kphp_compilation_proc, sanitizer_log_name)
+            sanitizer_log_prefix, kphp_compilation_proc, sanitizer_log_name)
         ignore_stderr = error_can_be_ignored(
-            ignore_patterns=[
-                "^Starting php to cpp transpiling\\.\\.\\.$",
-                "^Starting make\\.\\.\\.$",
-                "^objs cnt = \\d+$",
-                "^\\s*\\d+\\% \\[total jobs \\d+\\] \\[left jobs \\d+\\] \\[running jobs \\d+\\] \\[waiting jobs \\d+\\]$"
-            ],
+            ignore_regex=_KPHP_BUILD_STDERR_IGNORE_REGEX,
             binary_error_text=kphp_build_stderr)
         if not ignore_stderr:
             return_code = kphp_compilation_proc.returncode